@@ -1,8 +1,19 @@
 import os
-from flask import Flask, flash, jsonify, render_template, request, redirect, session, url_for
+import json
+import hashlib
+import select
+import stat
+import threading
+import time
+from collections import OrderedDict
+from flask import Flask, Response, flash, g, jsonify, render_template, request, redirect, session, stream_with_context, url_for
+from flask import before_render_template, template_rendered
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
 from werkzeug.security import generate_password_hash, check_password_hash
 from decimal import Decimal
 import psycopg2  # Cambiamos mysql.connector por psycopg2
+import psycopg2.extras
 from psycopg2 import sql
 from dotenv import load_dotenv
 from flask import jsonify
@@ -13,6 +24,119 @@ load_dotenv()
 app = Flask(__name__, template_folder='templates', static_folder='static')
 app.secret_key = os.getenv('SECRET_KEY')
 
+# --------------------------- CACHÉ DE PLANTILLAS ---------------------------
+
+class CacheFragmentos:
+    """Caché LRU en memoria para fragmentos ya renderizados.
+
+    Cada fragmento (nombre + variantes) guarda solo su última versión de datos:
+    una versión nueva reemplaza a la anterior en lugar de acumular copias viejas.
+    """
+
+    def __init__(self, max_entradas=256):
+        self.max_entradas = max_entradas
+        self.entradas = OrderedDict()
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def get(self, clave, version):
+        with self.lock:
+            entrada = self.entradas.get(clave)
+            if entrada is None or entrada[0] != version:
+                self.fallos += 1
+                return None
+            self.entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[1]
+
+    def set(self, clave, version, valor):
+        with self.lock:
+            self.entradas[clave] = (version, valor)
+            self.entradas.move_to_end(clave)
+            # Se descarta el fragmento usado hace más tiempo
+            while len(self.entradas) > self.max_entradas:
+                self.entradas.popitem(last=False)
+
+
+class FragmentCacheExtension(Extension):
+    """Agrega {% cache 'nombre', version, ... %}...{% endcache %} a las plantillas."""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=CacheFragmentos())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        nombre = parser.parse_expression()
+        parser.stream.expect('comma')
+        version = parser.parse_expression()
+        # Lo que siga a la versión (p. ej. filtros activos) distingue variantes del fragmento
+        variantes = []
+        while parser.stream.skip_if('comma'):
+            variantes.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        clave = nodes.Tuple([nombre] + variantes, 'load')
+        return nodes.CallBlock(
+            self.call_method('_cache_support', [clave, version]), [], [], body
+        ).set_lineno(lineno)
+
+    def _cache_support(self, clave, version, caller):
+        cache = self.environment.fragment_cache
+        rv = cache.get(clave, version)
+        if rv is None:
+            rv = caller()
+            cache.set(clave, version, rv)
+        return rv
+
+
+def version_datos(filas):
+    # Huella corta de los datos que alimentan un fragmento; cambia si cambian los datos
+    return hashlib.blake2b(repr(list(filas)).encode(), digest_size=8).hexdigest()
+
+
+def crear_bytecode_cache(directorio):
+    # Sin directorio configurado Jinja usa uno propio por usuario (0700, verifica el dueño)
+    if not directorio:
+        return FileSystemBytecodeCache()
+    # El bytecode se carga con marshal: nadie más puede poder escribir en el directorio
+    os.makedirs(directorio, mode=0o700, exist_ok=True)
+    # En Windows no hay uid ni bits de permisos POSIX: se usa el directorio tal cual
+    if not hasattr(os, 'getuid'):
+        return FileSystemBytecodeCache(directorio)
+    info = os.lstat(directorio)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() \
+            or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise RuntimeError(f'JINJA_CACHE_DIR inseguro: {directorio} debe ser un directorio propio con permisos 0700')
+    return FileSystemBytecodeCache(directorio)
+
+
+# Bytecode compilado compartido entre workers (escrituras atómicas de Jinja)
+app.jinja_env.bytecode_cache = crear_bytecode_cache(os.getenv('JINJA_CACHE_DIR'))
+app.jinja_env.add_extension(FragmentCacheExtension)
+
+# Métricas de renderizado por plantilla: cantidad, tiempo total y máximo (ms)
+metricas_render = {}
+metricas_lock = threading.Lock()
+
+@before_render_template.connect_via(app)
+def iniciar_render(sender, template, context, **extra):
+    g.setdefault('inicio_render', {})[template.name] = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def registrar_render(sender, template, context, **extra):
+    inicio = g.get('inicio_render', {}).pop(template.name, None)
+    if inicio is None:
+        return
+    ms = (time.perf_counter() - inicio) * 1000
+    with metricas_lock:
+        m = metricas_render.setdefault(template.name, {'renders': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        m['renders'] += 1
+        m['total_ms'] += ms
+        m['max_ms'] = max(m['max_ms'], ms)
+
 # Función para conectar a PostgreSQL
 def conectar():
     return psycopg2.connect(
@@ -33,6 +157,142 @@ def requiere_admin(f):
     decorador.__name__ = f.__name__
     return decorador
 
+# --------------------------- STOCK EN VIVO (LISTEN/NOTIFY + SSE) ---------------------------
+
+# Canal de PostgreSQL donde se publican los cambios de stock
+CANAL_STOCK = 'stock_productos'
+# Segundos sin eventos antes de mandar un keepalive al navegador
+SSE_KEEPALIVE = 15
+# Duración máxima de cada stream; después EventSource se reconecta solo
+SSE_DURACION_MAX = 300
+# Milisegundos que espera el navegador antes de reconectarse
+SSE_RETRY_MS = 3000
+
+def producto_stock(producto_id, nombre, precio, stock):
+    return {
+        'id': int(producto_id),
+        'nombre': nombre,
+        'precio': f"{float(precio):.2f}",
+        'stock': int(stock)
+    }
+
+def notificar_stock(cursor, producto_id, nombre, precio, stock):
+    # NOTIFY es transaccional: se entrega recién cuando se hace el commit
+    payload = json.dumps(producto_stock(producto_id, nombre, precio, stock))
+    cursor.execute("SELECT pg_notify(%s, %s)", (CANAL_STOCK, payload))
+
+
+class SuscriptorStock:
+    """Cambios pendientes de un cliente SSE; solo se guarda el último por producto."""
+
+    def __init__(self):
+        self.pendientes = {}
+        self.lock = threading.Lock()
+        self.hay_cambios = threading.Event()
+
+    def publicar(self, productos):
+        with self.lock:
+            for p in productos:
+                self.pendientes[p['id']] = p
+            self.hay_cambios.set()
+
+    def tomar(self, timeout):
+        self.hay_cambios.wait(timeout)
+        with self.lock:
+            productos = list(self.pendientes.values())
+            self.pendientes = {}
+            self.hay_cambios.clear()
+        return productos
+
+
+class EscuchaStock:
+    """Un único LISTEN por worker que reparte las notificaciones a los clientes SSE."""
+
+    def __init__(self, canal):
+        self.canal = canal
+        self.suscriptores = set()
+        # Último stock conocido de cada producto, para los clientes que se conectan
+        self.estado = {}
+        self.lock = threading.Lock()
+        self.hilo = None
+
+    def suscribir(self):
+        suscriptor = SuscriptorStock()
+        with self.lock:
+            self.suscriptores.add(suscriptor)
+            suscriptor.publicar(self.estado.values())
+            # El hilo se arranca con el primer cliente (y se relanza si murió)
+            if self.hilo is None or not self.hilo.is_alive():
+                self.hilo = threading.Thread(target=self._escuchar, daemon=True)
+                self.hilo.start()
+        return suscriptor
+
+    def desuscribir(self, suscriptor):
+        with self.lock:
+            self.suscriptores.discard(suscriptor)
+
+    def _repartir(self, productos):
+        with self.lock:
+            for p in productos:
+                self.estado[p['id']] = p
+            suscriptores = list(self.suscriptores)
+        for suscriptor in suscriptores:
+            suscriptor.publicar(productos)
+
+    def _escuchar(self):
+        while True:
+            conn = None
+            try:
+                conn = conectar()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.canal)))
+                    # Foto completa después del LISTEN: cubre lo perdido mientras no escuchábamos
+                    cursor.execute("SELECT id, nombre, precio, stock FROM productos")
+                    self._repartir([producto_stock(*fila) for fila in cursor.fetchall()])
+                while True:
+                    if select.select([conn], [], [], SSE_KEEPALIVE) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._repartir([json.loads(conn.notifies.pop(0).payload)])
+            except Exception:
+                app.logger.exception('Escucha de stock desconectada, reintentando')
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+escucha_stock = EscuchaStock(CANAL_STOCK)
+
+@app.route('/stock/stream')
+def stock_stream():
+    if 'usuario' not in session:
+        return jsonify({'success': False, 'message': 'No autorizado'}), 401
+
+    def eventos():
+        # Alta y baja en el mismo alcance: si la respuesta se cierra antes de
+        # arrancar el generador, nunca se llega a suscribir
+        suscriptor = escucha_stock.suscribir()
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            fin = time.monotonic() + SSE_DURACION_MAX
+            while time.monotonic() < fin:
+                productos = suscriptor.tomar(SSE_KEEPALIVE)
+                if not productos:
+                    yield ": keepalive\n\n"
+                for p in productos:
+                    yield f"event: stock\ndata: {json.dumps(p)}\n\n"
+        finally:
+            escucha_stock.desuscribir(suscriptor)
+
+    return Response(
+        stream_with_context(eventos()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 # --------------------------- AUTENTICACIÓN ---------------------------
 
 @app.route('/', methods=['GET', 'POST'])
@@ -207,13 +467,19 @@ def productos():
                     stock=%s, marca=%s, rubro=%s WHERE id=%s""",
                     (nombre, costo, precio, stock, marca, rubro, editar_id)
                 )
-                mensaje = "Producto actualizado con éxito."
+                if cursor.rowcount:
+                    notificar_stock(cursor, editar_id, nombre, precio, stock)
+                    mensaje = "Producto actualizado con éxito."
+                else:
+                    mensaje = "Producto no encontrado."
             else:
                 cursor.execute(
                     """INSERT INTO productos (nombre, costo, precio, stock, marca, rubro)
                     VALUES (%s, %s, %s, %s, %s, %s) RETURNING id""",
                     (nombre, costo, precio, stock, marca, rubro)
                 )
+                nuevo_id = cursor.fetchone()[0]
+                notificar_stock(cursor, nuevo_id, nombre, precio, stock)
                 mensaje = f'¡Producto registrado con éxito! Precio de venta: ${precio:.2f}'
             conn.commit()
         except Exception as e:
@@ -255,7 +521,7 @@ def ver_ventas():
     offset = (page - 1) * per_page
 
     conn = conectar()
-    cursor = conn.cursor(dictionary=True)
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
     # --- Consulta principal con filtros ---
     sql_base = """
@@ -329,7 +595,9 @@ def ver_ventas():
         total=round(total_ventas, 2),
         ganancia=round(ganancia_total, 2),
         top5=top5,
+        version_top5=version_datos(top5),
         vendedores=vendedores,
+        version_vendedores=version_datos(vendedores),
         deudas=deudas,
         page=page,
         total_pages=total_pages
@@ -410,6 +678,7 @@ def venta():
     return render_template(
         'venta.html',
         productos=productos,
+        version_productos=version_datos(productos),
         clientes=clientes,
         ventas=ventas,
         pagina=pagina,
@@ -482,6 +751,7 @@ def handle_venta_post(conn, cursor, usuario, productos):
         cursor.execute("""
             UPDATE productos SET stock = %s WHERE id = %s
         """, (nuevo_stock, producto_id))
+        notificar_stock(cursor, producto_id, producto['nombre'], producto['precio'], nuevo_stock)
 
         # Registrar deuda si es cuenta corriente
         if forma_pago.lower() == 'cuenta corriente':
@@ -592,7 +862,7 @@ def cuentas_corrientes():
         return redirect(url_for('login'))
     
     conn = conectar()
-    cursor = conn.cursor(dictionary=True)
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
     # Obtener deudas pendientes
     cursor.execute("""
@@ -608,7 +878,25 @@ def cuentas_corrientes():
     cursor.close()
     conn.close()
     
-    return render_template('cuentas_corrientes.html', deudas=deudas)
+    return render_template('cuentas_corrientes.html', deudas=deudas, version_deudas=version_datos(deudas))
+
+@app.route('/metricas/templates')
+@requiere_admin
+def metricas_templates():
+    with metricas_lock:
+        plantillas = {
+            nombre: dict(m, promedio_ms=m['total_ms'] / m['renders'])
+            for nombre, m in metricas_render.items()
+        }
+    cache = app.jinja_env.fragment_cache
+    return jsonify({
+        'plantillas': plantillas,
+        'fragmentos': {
+            'entradas': len(cache.entradas),
+            'aciertos': cache.aciertos,
+            'fallos': cache.fallos
+        }
+    })
 
 @app.route('/logout')
 def logout():
@@ -0,0 +1,11 @@
+import os
+
+# Los streams de stock (/stock/stream) quedan abiertos hasta SSE_DURACION_MAX:
+# con workers sync cada terminal bloquearía un worker entero, así que usamos hilos.
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+# Cada terminal con venta.html abierta ocupa un hilo
+threads = int(os.getenv('GUNICORN_THREADS', '50'))
+# El stream manda keepalive cada 15 s, el timeout tiene que ser mayor
+timeout = 60